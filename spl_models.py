@@ -1,6 +1,9 @@
 from astropy.modeling.models import Voigt1D
 import numpy as np
 
+# Ratio between the FWHM and the standard deviation of a Gaussian:
+FWHM_TO_SIGMA = 2*np.sqrt(2*np.log(2))
+
 # Analytical single distributions:
 def gauss(x, loc, a0, sd):
     diff = x-loc
@@ -17,7 +20,7 @@ def lorentzian(x, loc, a0, gamma):
 
 def voigt(x, loc, a0, sd, gamma):
     fwhm_L = 2*gamma
-    fwhm_G = 2*np.sqrt(2*np.log(2))*sd
+    fwhm_G = FWHM_TO_SIGMA*sd
     return Voigt1D(x_0=loc, amplitude_L=a0, fwhm_L=fwhm_L, fwhm_G=fwhm_G)(x)
 
 def continuum_function(x, a, b, c):
@@ -25,6 +28,14 @@ def continuum_function(x, a, b, c):
         a == 0
     return a*(x/b)**(-c)
 
+def continuum_jacobian(x, a, b, c):
+    '''
+    Derivatives of the continuum function with respect to its parameters (a, b, c), one column
+    per parameter.
+    '''
+    power = (x/b)**(-c)
+    return np.column_stack((power, a*c/b*power, -a*power*np.log(x/b)))
+
 # Velocity conversion:
 def vel_correct(l0, l):
     '''
@@ -3,7 +3,6 @@ This is the script containing the functions to set up properly the data for the
 methods.
 '''
 import os
-import random
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -18,213 +17,284 @@ import spl_config as spc
 ## EMISSION LINE PRELIMINARY ANALYSIS: =============================================================
 ## This part contains the functions
 
-def analyze_emission_lines(x, y, lines_dict, window=20.):
+def apply_continuum_mask(continuum_mask, synthetic_flux, flux, line_starts, line_ends, noise,
+                         flux_has_nan=True):
+    '''
+    Mask out the pixel ranges of the lines and fill them with synthetic noise at a tenth of the
+    dispersion of the rest of the spectrum.
+    :param continuum_mask: Boolean mask of the continuum pixels, updated in place
+    :param synthetic_flux: Continuum flux, updated in place
+    :param flux: Observed flux
+    :param line_starts: First pixel of every line
+    :param line_ends: Pixel after the last one of every line
+    :param noise: Standard normal noise, one value per pixel of the spectrum
+    :param flux_has_nan: Whether the flux has any NaN. If not, the plain reductions are used.
+    '''
+    _std = np.nanstd if flux_has_nan else np.std
+    for i0, i1 in zip(line_starts, line_ends):
+        continuum_mask[i0:i1] = False
+        if i1 > i0:
+            valid_flux = np.concatenate((flux[:i0], flux[i1:]))
+            if valid_flux.size > 0 and not (flux_has_nan and np.isnan(valid_flux).all()):
+                std_flux = _std(valid_flux)
+                synthetic_flux[i0:i1] = 0.1 * std_flux * noise[i0:i1]
+            else:
+                synthetic_flux[i0:i1] = 0  # Fallback if no valid data is available
+
+def analyze_emission_lines(x, y, lines_dict, window=20., seed=None):
     '''
     Identify emission lines in a given observed spectrum and return the results.
     :param spectrum:
     :param lines_dict:
     :param window:
+    :param seed: Seed (or np.random.Generator / np.random.RandomState) of the synthetic noise
+        filling the line regions of the continuum. If None, the global np.random state is used,
+        so np.random.seed applies.
     :return:
     '''
     observed_wavelengths = x
     flux = y
 
     matched_lines = []
-    results = []
     synthetic_flux = np.copy(flux)  # This maintains the original 1D flux array structure
 
     # Ensure the synthetic_flux initialization doesn't start with NaN values
-    if np.isnan(synthetic_flux).all():
+    flux_nans = np.isnan(flux)
+    flux_has_nan = flux_nans.any()
+    if flux_has_nan and flux_nans.all():
         synthetic_flux[:] = 0  # Set to zero or some baseline if entirely NaN
 
     continuum_mask = np.ones(len(flux), dtype=bool)
+
+    # Find the peaks once over the whole spectrum and bucket them into the line windows. The
+    # wavelengths are sorted, so each window is a contiguous slice of the peak list:
+    wl = np.ascontiguousarray(observed_wavelengths)
+    peaks, _ = find_peaks(flux, prominence=0.5)
+    peak_wls = wl[peaks]
     for name, params in lines_dict.items():
         rest_wavelength = params['wavelength'][0]
         if rest_wavelength is not None:
-            lower_bound = rest_wavelength - window
-            upper_bound = rest_wavelength + window
-            mask = (observed_wavelengths >= lower_bound) & (observed_wavelengths <= upper_bound)
-            window_flux = flux[mask]
-            window_wavelengths = observed_wavelengths[mask]
-
-            # Verify the window selection:
-            # if window_wavelengths.size:
-                # No other option but plotting. What the heck is happening here?
-                # plt.plot(window_wavelengths, window_flux)
-                # plt.show()
-                # print('len window_wavelengths', len(window_wavelengths))
-                # print('This is the maximum flux inside the window', np.nanmax(window_flux))
-
-            if not window_wavelengths.size:
-                continue
-
-            peaks, _ = find_peaks(window_flux, prominence=0.5)
-            closest_peak_idx = None
-            min_diff = float('inf')
-
-            for peak_idx in peaks:
-                ## This lines were meant to identify the closest peak, but they might screw up
-                # the things if the redshift of the spectrum is not quite correct.
-
-                observed_wavelength = window_wavelengths[peak_idx]
-                diff = abs(observed_wavelength - rest_wavelength)
-
-                if diff < min_diff:
-                    min_diff = diff
-                    closest_peak_idx = peak_idx
-
-            if closest_peak_idx is not None:
-                peak_flux = window_flux[closest_peak_idx]
-                observed_wavelength = window_wavelengths[closest_peak_idx]
-                matched_lines.append({
-                    'line': name,
-                    'restframe_wavelength': rest_wavelength,
-                    'observed_wavelength': observed_wavelength,
-                    'peak_flux': peak_flux,
-                    'peak_idx': np.where(observed_wavelengths == observed_wavelength)[0][0]
-                })
-
-
-    # Update continuum mask and calculate synthetic data for gaps
-    for line in matched_lines:
-        peak_idx = line['peak_idx']
-        widths, width_heights, left_ips, right_ips = peak_widths(flux, [peak_idx], rel_height=0.5)
-        fwhm = np.interp(left_ips + widths, np.arange(len(flux)), observed_wavelengths) - \
-               np.interp(left_ips, np.arange(len(flux)), observed_wavelengths)
-
-        sigma = fwhm[0] / 2.355
-        line_start = line['observed_wavelength'] - fwhm[0] / 2 - 3 * sigma
-        line_end = line['observed_wavelength'] + fwhm[0] / 2 + 3 * sigma
-
-        results.append({
-            'line': line['line'],
-            'restframe_wavelength': line['restframe_wavelength'],
-            'observed_wavelength': line['observed_wavelength'],
-            'fwhm': fwhm[0],
-            'peak_flux': line['peak_flux']
-        })
-
-        mask = ((observed_wavelengths >= line_start) & (observed_wavelengths <= line_end))
-        continuum_mask &= ~mask
-        if np.any(mask):
-            valid_flux = flux[~mask]
-            if valid_flux.size > 0 and not np.isnan(valid_flux).all():
-                mean_flux = np.nanmean(valid_flux)
-                std_flux = np.nanstd(valid_flux)
-                synthetic_flux[mask] = np.random.normal(0.0, 0.1 * std_flux, np.sum(mask))
-            else:
-                synthetic_flux[mask] = 0  # Fallback if no valid data is available
+            lo = np.searchsorted(peak_wls, rest_wavelength - window, side='left')
+            hi = np.searchsorted(peak_wls, rest_wavelength + window, side='right')
 
-    # Apply the mask to keep only continuum points
-    continuum_spectrum = np.column_stack((observed_wavelengths, synthetic_flux))
-    std_cont = np.nanstd(continuum_spectrum[:,1])
-    return results, std_cont, continuum_spectrum
+            if hi == lo:
+                continue
 
+            ## This lines were meant to identify the closest peak, but they might screw up
+            # the things if the redshift of the spectrum is not quite correct.
+            closest = lo + np.argmin(np.abs(peak_wls[lo:hi] - rest_wavelength))
+            peak_idx = peaks[closest]
+            matched_lines.append({
+                'line': name,
+                'restframe_wavelength': rest_wavelength,
+                'observed_wavelength': wl[peak_idx],
+                'peak_flux': flux[peak_idx],
+                'peak_idx': peak_idx
+            })
+
+
+    # Measure all the FWHMs in a single pass, converting the pixel widths to wavelengths:
+    idxs = np.fromiter((line['peak_idx'] for line in matched_lines), dtype=np.intp,
+                       count=len(matched_lines))
+    widths, width_heights, left_ips, right_ips = peak_widths(flux, idxs, rel_height=0.5)
+    steps = np.diff(wl)
+    if steps.size and np.allclose(steps, steps[0], rtol=1e-6, atol=0.):
+        # Uniform wavelength grid: the widths just scale with the pixel size
+        fwhms = widths * steps[0]
+    else:
+        xgrid = np.arange(len(flux))
+        fwhms = np.interp(left_ips + widths, xgrid, observed_wavelengths) - \
+                np.interp(left_ips, xgrid, observed_wavelengths)
+
+    sigmas = fwhms / 2.355
+    line_wls = wl[idxs]
+    line_starts = np.searchsorted(wl, line_wls - fwhms / 2 - 3 * sigmas, side='left')
+    line_ends = np.searchsorted(wl, line_wls + fwhms / 2 + 3 * sigmas, side='right')
+
+    results = [{
+        'line': line['line'],
+        'restframe_wavelength': line['restframe_wavelength'],
+        'observed_wavelength': line['observed_wavelength'],
+        'fwhm': fwhm,
+        'peak_flux': line['peak_flux']
+    } for line, fwhm in zip(matched_lines, fwhms)]
+
+    # Update continuum mask and calculate synthetic data for gaps, drawing the noise just once
+    if seed is None:
+        noise = np.random.standard_normal(len(flux))
+    elif isinstance(seed, np.random.RandomState):
+        noise = seed.standard_normal(len(flux))
+    else:
+        noise = np.random.default_rng(seed).standard_normal(len(flux))
+    apply_continuum_mask(continuum_mask, synthetic_flux, flux, line_starts, line_ends, noise,
+                         flux_has_nan=flux_has_nan)
+
+    # The continuum spectrum is returned as a (wavelengths, flux) pair of 1D arrays
+    std_cont = np.nanstd(synthetic_flux) if flux_has_nan else np.std(synthetic_flux)
+    return results, std_cont, (observed_wavelengths, synthetic_flux)
+
+
+def window_stats(values, starts, ends):
+    '''
+    Mean and standard deviation of values over many windows at once. The window values are
+    gathered into one array and reduced per window with np.add.reduceat, in two passes (mean, then
+    deviations from it) as np.std does, so flat windows give a standard deviation of exactly 0.
+    Empty windows and windows containing NaNs give NaN, as np.mean and np.std would.
+    :param values: 1D array of values
+    :param starts: First index of every window
+    :param ends: Index after the last one of every window
+    :return: The arrays of means and standard deviations
+    '''
+    n = np.maximum(ends - starts, 0)
+    mean = np.full(len(n), np.nan)
+    std = np.full(len(n), np.nan)
+    nonempty = n > 0
+    if not nonempty.any():
+        return mean, std
+
+    sizes = n[nonempty]
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    # Indices of the values of every window, one window after the other:
+    idx = np.repeat(starts[nonempty] - offsets, sizes) + np.arange(sizes.sum())
+    gathered = values[idx]
+
+    window_mean = np.add.reduceat(gathered, offsets) / sizes
+    deviations = gathered - np.repeat(window_mean, sizes)
+    mean[nonempty] = window_mean
+    std[nonempty] = np.sqrt(np.add.reduceat(deviations**2, offsets) / sizes)
+    return mean, std
+
+
+# Numerical fields of the filtered line list, one record per line. The 'name' field goes first and
+# is sized to the longest line name when the list is built:
+LINELIST_FIELDS = [('wavelength', 'f8'), ('sigma', 'f8'), ('min_loc', 'f8'), ('max_loc', 'f8'),
+                   ('min_sd', 'f8'), ('max_sd', 'f8'), ('max_flux', 'f8'), ('SNR', 'f8')]
 
 def filter_and_prepare_linelist(line_results, continuum_spec0, wavelength_range, snr_ext,
                                 window_width=10.):
     min_wavelength, max_wavelength = wavelength_range
-    filtered_linelist = []
     # If noise standard deviation is not provided, assume a default or calculate externally
 
     three_sigma = 3 * snr_ext  # 3 sigma threshold for noise
 
-    for line in line_results:
-        name = line['line']
-        line_wavelength = line['observed_wavelength']
-        line_fwhm = line['fwhm']
-        line_flux = line['peak_flux']
-        sigma_max = line_fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))  # Convert FWHM to sigma
-
-        # Filter based on the wavelength range and FWHM constraints
-        if min_wavelength <= line_wavelength <= max_wavelength:
-            lineloc_min = line_wavelength - 2 * sigma_max
-            lineloc_max = line_wavelength + 2 * sigma_max
-
-            window_left = continuum_spec0[(continuum_spec0[:, 0] <= lineloc_min) &
-                                          (continuum_spec0[:, 0] >= lineloc_min - window_width)]
-            window_right = continuum_spec0[(continuum_spec0[:, 0] <= lineloc_max + window_width) &
-                                           (continuum_spec0[:, 0] >= lineloc_max)]
-
-            local_std = np.mean([np.std(window_left[:, 1]), np.std(window_right[:, 1])])
-            local_mean = np.mean([np.mean(window_left[:, 1]), np.mean(window_right[:, 1])])
-
-            # Evaluate inf snr in the line region is good regardless of entire spectrum
-            snr = (line_flux - local_mean) / local_std if local_std > 0 else snr_ext
-
-            # Check if the SNR is above the threshold and the peak flux is significant above 3 sigma
-            if snr >= snr_ext or line_flux > three_sigma:
-                line_details = {
-                    'name': name,
-                    'wavelength': line_wavelength,
-                    'sigma': sigma_max,
-                    'min_loc': lineloc_min,
-                    'max_loc': lineloc_max,
-                    'min_sd': 2.0,
-                    'max_sd': 1.5*sigma_max,
-                    'max_flux': line_flux,
-                    'SNR': snr,  # Including SNR in the output for reference
-                }
-                filtered_linelist.append(line_details)
+    # Gather the line properties into arrays:
+    names = [line['line'] for line in line_results]
+    line_wavelength = np.array([line['observed_wavelength'] for line in line_results], dtype=float)
+    line_fwhm = np.array([line['fwhm'] for line in line_results], dtype=float)
+    line_flux = np.array([line['peak_flux'] for line in line_results], dtype=float)
+    sigma_max = line_fwhm / spm.FWHM_TO_SIGMA  # Convert FWHM to sigma
+
+    lineloc_min = line_wavelength - 2 * sigma_max
+    lineloc_max = line_wavelength + 2 * sigma_max
+
+    # The continuum wavelengths are sorted, so the windows on each side are contiguous slices:
+    x_cont, y_cont = continuum_spec0
+    left_mean, left_std = window_stats(y_cont,
+                                       np.searchsorted(x_cont, lineloc_min - window_width, 'left'),
+                                       np.searchsorted(x_cont, lineloc_min, 'right'))
+    right_mean, right_std = window_stats(y_cont,
+                                         np.searchsorted(x_cont, lineloc_max, 'left'),
+                                         np.searchsorted(x_cont, lineloc_max + window_width, 'right'))
+
+    local_std = (left_std + right_std) / 2
+    local_mean = (left_mean + right_mean) / 2
+
+    # Evaluate inf snr in the line region is good regardless of entire spectrum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        snr = np.where(local_std > 0, (line_flux - local_mean) / local_std, snr_ext)
+
+    # Filter based on the wavelength range, then check if the SNR is above the threshold and the
+    # peak flux is significant above 3 sigma
+    keep = np.flatnonzero((min_wavelength <= line_wavelength) & (line_wavelength <= max_wavelength) &
+                          ((snr >= snr_ext) | (line_flux > three_sigma)))
+
+    kept_names = [names[i] for i in keep]
+    linelist_dtype = np.dtype([('name', f'U{max(map(len, kept_names), default=1)}')] +
+                              LINELIST_FIELDS)
+    filtered_linelist = np.empty(len(keep), dtype=linelist_dtype)
+    filtered_linelist['name'] = kept_names
+    filtered_linelist['wavelength'] = line_wavelength[keep]
+    filtered_linelist['sigma'] = sigma_max[keep]
+    filtered_linelist['min_loc'] = lineloc_min[keep]
+    filtered_linelist['max_loc'] = lineloc_max[keep]
+    filtered_linelist['min_sd'] = 2.0
+    filtered_linelist['max_sd'] = 1.5*sigma_max[keep]
+    filtered_linelist['max_flux'] = line_flux[keep]
+    filtered_linelist['SNR'] = snr[keep]  # Including SNR in the output for reference
     return filtered_linelist
 
 
 def continuum_init(continuum_spec, g_init):
     '''
     Initial guess for the parameters of the continuum. It uses a first approach fit with
-    :param continuum_spec:
+    :param continuum_spec: (wavelengths, flux) pair of the continuum spectrum
     :return:
     '''
-    x_continuum = continuum_spec[:, 0]
-    y_continuum = continuum_spec[:, 1]
+    x_continuum, y_continuum = continuum_spec
+    # Drop the non-finite points here, so the fit itself can skip the finiteness check:
+    finite = np.isfinite(x_continuum) & np.isfinite(y_continuum)
+    if not finite.all():
+        x_continuum = x_continuum[finite]
+        y_continuum = y_continuum[finite]
     a_init = np.mean(y_continuum)
     loc0_init = np.min(x_continuum)
     p0 = [a_init, loc0_init, g_init]
-    params, params_covariance = curve_fit(spm.continuum_function, x_continuum, y_continuum, p0=p0)
+    # curve_fit already memoizes the model and Jacobian at p0 (scipy gh-13670), so they are
+    # passed unwrapped:
+    params, params_covariance = curve_fit(spm.continuum_function, x_continuum, y_continuum, p0=p0,
+                                          jac=spm.continuum_jacobian, check_finite=False,
+                                          xtol=1e-6, ftol=1e-6)
 
     return params
 
 
+# Scale of the standard deviation and of the gamma parameter relative to the Gaussian sigma of the
+# line, for every model (NaN when the model has no gamma parameter):
+MODEL_WIDTH_SCALES = {
+    'Gaussian': (1., np.nan),
+    'Lorentzian': (1.11, np.nan),
+    'Voigt': (1., 1.11),
+}
+
 def initial_dataframe(emlines_dict, filtered_linelist, continuum_pars=None):
     '''
     This function creates an initial parameters dataframe given the emission lines dictionary.
     :param emlines_dict: The dictionary of emission lines
     :return:
     '''
-    # Initialize lists to hold data for DataFrame
-    line_names = []
-    models = []
-    ncomp = []
-    parameters = []
-    min_limits = []
-    max_limits = []
-
-    emlines = emlines_dict.keys()
-    for line in filtered_linelist:
-        line_name = line['name']
-        components = [emlines_dict[line_name]['components']]
-        Ncomp = len(components)
-        for j, component in enumerate(components):
-            if component == 'Voigt':
-                params_i = [line['wavelength'], line['max_flux']/Ncomp, line['sigma'],
-                            1.11*line['sigma']]
-                max_i = [line['max_loc'], line['max_flux'], line['max_sd'], 1.11*line['max_sd']]
-                min_i = [line['min_loc'], 0., line['min_sd'], 1.11*line['min_sd']]
-            elif component == 'Gaussian':
-                params_i = [line['wavelength'], line['max_flux']/Ncomp, line['sigma']]
-                max_i = [line['max_loc'], line['max_flux'], line['max_sd']]
-                min_i = [line['min_loc'], 0., line['min_sd']]
-            elif component == 'Lorentzian':
-                params_i = [line['wavelength'], line['max_flux']/Ncomp, 1.11*line['sigma']]
-                max_i = [line['max_loc'], line['max_flux'], 1.11*line['max_sd']]
-                min_i = [line['min_loc'], 0., 1.11*line['min_sd']]
-
-            line_names.append(line_name)
-            models.append(component)  # Assuming wavelength as centroid
-            ncomp.append(j+1)  # Using max_flux as initial guess for amplitude
-            parameters.append(params_i)
-            min_limits.append(min_i)
-            max_limits.append(max_i)
+    # Each line starts with a single component of the model given in the emission lines dictionary
+    line_names = filtered_linelist['name'].tolist()
+    models = [emlines_dict[line_name]['components'] for line_name in line_names]
+    ncomp = [1] * len(line_names)
+
+    # Scale of the standard deviation and of the extra gamma parameter (if any) of every model,
+    # applied to sigma and to its limits:
+    sd_scale, gamma_scale = np.array([MODEL_WIDTH_SCALES[model] for model in models],
+                                     dtype=float).reshape(-1, 2).T
+    nparams = np.where(np.isnan(gamma_scale), 3, 4)
+
+    params_mat = np.column_stack((filtered_linelist['wavelength'], filtered_linelist['max_flux'],
+                                  sd_scale*filtered_linelist['sigma'],
+                                  gamma_scale*filtered_linelist['sigma']))
+    max_mat = np.column_stack((filtered_linelist['max_loc'], filtered_linelist['max_flux'],
+                               sd_scale*filtered_linelist['max_sd'],
+                               gamma_scale*filtered_linelist['max_sd']))
+    min_mat = np.column_stack((filtered_linelist['min_loc'], np.zeros(len(line_names)),
+                               sd_scale*filtered_linelist['min_sd'],
+                               gamma_scale*filtered_linelist['min_sd']))
+
+    parameters = [row[:n] for row, n in zip(params_mat.tolist(), nparams)]
+    max_limits = [row[:n] for row, n in zip(max_mat.tolist(), nparams)]
+    min_limits = [row[:n] for row, n in zip(min_mat.tolist(), nparams)]
+
+    # The continuum is added as the last row
+    if continuum_pars is not None:
+        line_names.append('Continuum')
+        models.append('Continuum')
+        ncomp.append(0.0)
+        parameters.append(continuum_pars)
+        max_limits.append([np.inf, np.inf, np.inf])
+        min_limits.append([0, 0, 0])
 
     dfparams = pd.DataFrame({
         'Line Name': line_names,
@@ -235,38 +305,33 @@ def initial_dataframe(emlines_dict, filtered_linelist, continuum_pars=None):
         'Min Limits': min_limits,
     })
 
-    if continuum_pars is not None:
-        dfparams_cont = pd.DataFrame({
-            'Line Name': ['Continuum'],
-            'Model': ['Continuum'],  # Initial components set to 1
-            'Component': [0.0],
-            'Parameters': [continuum_pars],
-            'Max Limits': [[np.inf, np.inf, np.inf]],
-            'Min Limits': [[0, 0, 0]]
-        })
-
-        dfparams = pd.concat([dfparams, dfparams_cont], ignore_index=True)
-
     return dfparams
 
 
-def init_setup(spectrum, emlines_dict, wavelength_range, gamma_init):
+def init_setup(spectrum, emlines_dict, wavelength_range, gamma_init, seed=None):
     '''
     This function sets up all the objects necessary for the execution of the fit functions
     :param spectrum:
     :param lines_dict:
     :param gamma_init: Initial guess for
+    :param seed: Seed of the synthetic continuum noise, passed to analyze_emission_lines
     '''
 
-    spectrum = spectrum[(spectrum[:,0]>=wavelength_range[0]) & (spectrum[:,0]<=wavelength_range[1])]
+    # The line and continuum windows downstream are located with searchsorted, which needs the
+    # wavelengths in increasing order:
+    if np.any(np.diff(spectrum[:, 0]) < 0):
+        raise ValueError('The wavelengths of the spectrum must be sorted in increasing order.')
+
+    # First restrict the spectrum to the wavelength range, as a view of the original array:
+    i0 = np.searchsorted(spectrum[:, 0], wavelength_range[0], side='left')
+    i1 = np.searchsorted(spectrum[:, 0], wavelength_range[1], side='right')
+    spectrum = spectrum[i0:i1]
     x = spectrum[:, 0]
     y = spectrum[:, 1]
     dy = spectrum[:, 2]
-    
-    # First restrict the spectrum to the wavelength range:
 
     # Find the lines present in the spectrum and estimate first guesses for parameters:
-    lines_init, snr_cont, continuum0 = analyze_emission_lines(x, y, emlines_dict)
+    lines_init, snr_cont, continuum0 = analyze_emission_lines(x, y, emlines_dict, seed=seed)
 
     # Initial guess for the parameters of the continuum:
     continuum_pars = continuum_init(continuum0, gamma_init)
@@ -283,63 +348,67 @@ def init_setup(spectrum, emlines_dict, wavelength_range, gamma_init):
 # Functions to increase the number of components in the model:
 
 def minmaxlim(df):
-  min_limits = []
-  max_limits = []
-
-  for index, row in df.iterrows():
-
-      # Definitions
-      # standard deviation
-      sigma = row['Parameters'][2]
-      minsig = 2.0
-      maxsig = 1.5 * sigma
-      # wavelength
-      line_wavelength = row['Parameters'][0]
-      min_line = line_wavelength - 2 * sigma
-      max_line = line_wavelength + 2 * sigma
-      # amplitude
-      amplitude = row['Parameters'][1]
-      # components
-      ncomp = row['Component']
-
-      # Adjust maximum amplitude based on component number
-      # for the first component (which can have more than one or just one component afterwards)
-      if ncomp == 1:
-          # if there are multiple components for this line
-          if df[df['Line Name'] == row['Line Name']].shape[0] > 1:
-              amplitude_factor = 2
-          else:
-              amplitude_factor = 1
-      # for the second component
-      elif ncomp == 2:
-          amplitude_factor = 2
-      # for every other component
-      else:
-          amplitude_factor = 2**(ncomp-1)
-
-      # Calculate Limits
-      if row['Model'] == 'Gaussian':
-          max_i = [max_line, amplitude * amplitude_factor, maxsig]
-          min_i = [min_line, 0.                          , minsig]
-
-      elif row['Model'] == 'Lorentzian':
-          max_i = [max_line, amplitude * amplitude_factor, 1.11*maxsig]
-          min_i = [min_line, 0.                          , 1.11*minsig]
-
-      elif row['Model'] == 'Voigt':
-          max_i = [max_line, amplitude * amplitude_factor, maxsig, 1.11*maxsig]
-          min_i = [min_line, 0.                          , minsig, 1.11*minsig]
-
-      elif row['Model'] == 'Continuum':
-          max_i = [np.inf, np.inf, np.inf]
-          min_i = [-np.inf, 0    , -np.inf]
-      else:
-          print("Model not defined.")
-
-      min_limits.append(min_i)
-      max_limits.append(max_i)
-
-  return min_limits, max_limits
+    '''
+    Limits of the parameters for every row of a parameters dataframe, computed column-wise over
+    all the rows at once.
+    :param df: Parameters dataframe
+    :return: The lists of minimum and maximum limits, one list per row
+    '''
+    # Definitions: only the centroid, amplitude and standard deviation are needed
+    params = np.array([np.asarray(p, dtype=float)[:3] for p in df['Parameters']]).reshape(-1, 3)
+    # wavelength
+    line_wavelength = params[:, 0]
+    # amplitude
+    amplitude = params[:, 1]
+    # standard deviation
+    sigma = params[:, 2]
+    minsig = np.full(len(df), 2.0)
+    maxsig = 1.5 * sigma
+    min_line = line_wavelength - 2 * sigma
+    max_line = line_wavelength + 2 * sigma
+    # components
+    ncomp = df['Component'].to_numpy(dtype=float)
+    models = df['Model'].to_numpy()
+
+    # Adjust maximum amplitude based on component number: the first component is doubled only if
+    # the line has more than one component, every other one grows as 2**(ncomp - 1)
+    nlines = df.groupby('Line Name')['Line Name'].transform('size').to_numpy()
+    amplitude_factor = np.where(ncomp == 1, np.where(nlines > 1, 2., 1.), 2.**(ncomp - 1))
+    max_amplitude = amplitude * amplitude_factor
+    zeros = np.zeros(len(df))
+
+    # Calculate Limits, padded to four parameters per row:
+    max_mat = np.full((len(df), 4), np.nan)
+    min_mat = np.full((len(df), 4), np.nan)
+    nparams = np.zeros(len(df), dtype=int)
+
+    sel = models == 'Gaussian'
+    max_mat[sel, :3] = np.column_stack((max_line, max_amplitude, maxsig))[sel]
+    min_mat[sel, :3] = np.column_stack((min_line, zeros, minsig))[sel]
+    nparams[sel] = 3
+
+    sel = models == 'Lorentzian'
+    max_mat[sel, :3] = np.column_stack((max_line, max_amplitude, 1.11*maxsig))[sel]
+    min_mat[sel, :3] = np.column_stack((min_line, zeros, 1.11*minsig))[sel]
+    nparams[sel] = 3
+
+    sel = models == 'Voigt'
+    max_mat[sel] = np.column_stack((max_line, max_amplitude, maxsig, 1.11*maxsig))[sel]
+    min_mat[sel] = np.column_stack((min_line, zeros, minsig, 1.11*minsig))[sel]
+    nparams[sel] = 4
+
+    sel = models == 'Continuum'
+    max_mat[sel, :3] = [np.inf, np.inf, np.inf]
+    min_mat[sel, :3] = [-np.inf, 0, -np.inf]
+    nparams[sel] = 3
+
+    if not np.isin(models, ['Gaussian', 'Lorentzian', 'Voigt', 'Continuum']).all():
+        print("Model not defined.")
+
+    min_limits = [row[:n] for row, n in zip(min_mat.tolist(), nparams)]
+    max_limits = [row[:n] for row, n in zip(max_mat.tolist(), nparams)]
+
+    return min_limits, max_limits
 
 def update_components(dfparams, additional_components_dict):
     '''
@@ -352,33 +421,41 @@ def update_components(dfparams, additional_components_dict):
     num: number of iterations to run the mcmc chains
     '''
 
-    # Create a copy of the input dataframe to avoid modifying the original
-    updated_df = dfparams.copy()
+    # Copy of the input dataframe without the error column (if any), the original is not modified
+    updated_df = dfparams.drop(columns=['Parameter Errors'], errors='ignore')
 
-    # Remove error column
-    updated_df = updated_df.drop(['Parameter Errors'], axis=1)
-
-    # Iterate over the additional components dictionary
+    # Iterate over the additional components dictionary, collecting the new rows together with the
+    # position of the row they go after:
+    line_rows = updated_df.groupby('Line Name', sort=False).indices
+    new_rows = []
+    new_positions = []
 
     for line, components in additional_components_dict.items():
-      if (line in updated_df['Line Name'].values):
+      if line in line_rows:
         print("Adding a {} component for {}".format(components[0], line))
 
         # Find the last instance of the element
-        last_index = updated_df[updated_df['Line Name'] == line].index[-1]
+        last_index = line_rows[line][-1]
         # Add a new component
-        new_component_number = updated_df.loc[last_index, 'Component'] + 1
+        new_component_number = updated_df['Component'].iloc[last_index] + 1
 
         # Copy the same parameters, updating the initial amplitude guess
-        new_parameters = updated_df.loc[last_index, 'Parameters']
+        new_parameters = updated_df['Parameters'].iloc[last_index]
         new_parameters = [new_parameters[0], new_parameters[1]/2, new_parameters[2]]
 
-        new_row = {'Line Name': line, 'Component': new_component_number, 'Model': components[0], 'Parameters': new_parameters}
-        updated_df = pd.concat([updated_df[:last_index + 1], pd.DataFrame([new_row]), updated_df[last_index + 1:]], ignore_index=True)
+        new_rows.append({'Line Name': line, 'Component': new_component_number, 'Model': components[0], 'Parameters': new_parameters})
+        new_positions.append(last_index + 0.5)
 
       else:
         print(f"{line} not found in the Spectrum.")
 
+    # Insert all the new rows at once, each right after the last component of its line
+    if new_rows:
+        order = np.argsort(np.concatenate((np.arange(len(updated_df)), new_positions)),
+                           kind='stable')
+        updated_df = pd.concat([updated_df, pd.DataFrame(new_rows)], ignore_index=True)
+        updated_df = updated_df.iloc[order].reset_index(drop=True)
+
     # Calculate limits
 
     min_limits, max_limits = minmaxlim(updated_df)
@@ -393,47 +470,41 @@ def update_components(dfparams, additional_components_dict):
 
 # PLOTTING FUNCTION:   ==============================================================
 
+# Analytical function of every model in the parameters dataframe:
+MODEL_FUNCTIONS = {
+    'Continuum': spm.continuum_function,
+    'Gaussian': spm.gauss,
+    'Lorentzian': spm.lorentzian,
+    'Voigt': spm.voigt,
+    'Asymmetric Gaussian': spm.asym_gauss,
+}
+
 def spl_plot(x, y, dy, dfparams, x_zoom=None, y_zoom=None, goodness_marks=None):
     # Extract data from the DataFrame
 
     x_fit = np.linspace(min(x) - 10, max(x) + 10, 10000)
-    y_fit = np.zeros_like(x_fit)
-    y_evaluated = np.zeros_like(x)
 
     # Create a figure with two subplots (upper and lower panels)
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 5), sharex=True,
                                    gridspec_kw={'hspace': 0.0, 'height_ratios': [5, 2]})
 
-    # Upper panel: Observed spectrum, model, and individual Gaussian components
-    for _, row in dfparams.iterrows():
-        line_name = row['Line Name']
-        component = int(row['Component'])
-        model = row['Model']
-
-        if model == 'Continuum':
-            component_y = spm.continuum_function(x_fit, *row['Parameters'])
-            component_y_ev = spm.continuum_function(x, *row['Parameters'])
-        if model == 'Gaussian':
-            component_y = spm.gauss(x_fit, *row['Parameters'])
-            component_y_ev = spm.gauss(x, *row['Parameters'])
-        elif model == 'Lorentzian':
-            component_y = spm.lorentzian(x_fit, *row['Parameters'])
-            component_y_ev = spm.lorentzian(x, *row['Parameters'])
-        elif model == 'Voigt':
-            component_y = spm.voigt(x_fit, *row['Parameters'])
-            component_y_ev = spm.voigt(x, *row['Parameters'])
-        elif model == 'Asymmetric Gaussian':
-            component_y = spm.asym_gauss(x_fit, *row['Parameters'])
-            component_y_ev = spm.asym_gauss(x, *row['Parameters'])
+    # Evaluate every component on the plotting grid and on the observed wavelengths:
+    components_fit = np.empty((len(dfparams), x_fit.size))
+    components_ev = np.empty((len(dfparams), len(x)))
+    for i, (model, parameters) in enumerate(zip(dfparams['Model'], dfparams['Parameters'])):
+        model_function = MODEL_FUNCTIONS[model]
+        components_fit[i] = model_function(x_fit, *parameters)
+        components_ev[i] = model_function(x, *parameters)
 
-        # Plot individually the component:
+    y_fit = components_fit.sum(axis=0)
+    y_evaluated = components_ev.sum(axis=0)
 
-        color = (random.random(), random.random(), random.random())
+    # Upper panel: Observed spectrum, model, and individual Gaussian components
+    colors = plt.cm.tab20(np.linspace(0, 1, len(dfparams)))
+    for component_y, color in zip(components_fit, colors):
+        # Plot individually the component:
         ax1.plot(x_fit, component_y, linestyle='--', linewidth=0.8, color=color)
 
-        y_fit += component_y
-        y_evaluated += component_y_ev
-
     ax1.plot(x_fit, y_fit, color='crimson', linewidth=2.0, label='Total Fitted Spectrum')
     ax1.errorbar(x, y, yerr=dy, color='grey', linestyle='-',
                  marker='.', alpha=0.7, markersize=2, linewidth=0.7, label='Observed Spectrum')
@@ -496,24 +567,17 @@ def spl_savefile(fit, filename):
         lines_list.remove('Continuum')
 
 
-    # Create a dictionary to store the results
-    results_dict = pd.DataFrame({
-        'Line Name': [],
-        'Model': [],
-        'Component': [],
-        'Centroid': [],
-        'Amplitude': [],
-        'Sigma / A factor': [],
-        'Sigma (km/s)': [],
-        'Gamma / w width': [],
-        'Gamma (km/s)': [],
-        'err_Centroid': [],
-        'err_Amplitude': [],
-        'err_Sigma / err_A': [],
-        'err_Sigma (km/s)': [],
-        'err_Gamma / err_w': [],
-        'err_Gamma (km/s)': [],
-    })
+    # Create a dictionary of column lists to store the results; the table is built once at the end
+    columns = ['Line Name', 'Model', 'Component', 'Centroid', 'Amplitude', 'Sigma / A factor',
+               'Sigma (km/s)', 'Gamma / w width', 'Gamma (km/s)', 'err_Centroid', 'err_Amplitude',
+               'err_Sigma / err_A', 'err_Sigma (km/s)', 'err_Gamma / err_w', 'err_Gamma (km/s)',
+               'err_Sigma', 'err_Gamma', 'Sigma']
+    results_dict = {col: [] for col in columns}
+
+    def append_row(row):
+        # Columns not given in the row are left empty:
+        for col in columns:
+            results_dict[col].append(row.get(col, np.nan))
 
     # Populate the dictionary with the results
     param_start = 0
@@ -522,10 +586,7 @@ def spl_savefile(fit, filename):
         Ncomp = fit.model_parameters_df[fit.model_parameters_df['Line Name'] == line][
             'Component'].max()
         for j in range(Ncomp):
-            results_dict.loc[r, 'Line Name'] = line
-            results_dict.loc[r, 'Component'] = j+1
             model = models[r]
-            results_dict.loc[r,'Model'] = model
             # Extracting parameters:s
             # Centroid:
             centroid = theta_max[param_start + j * 3]
@@ -567,18 +628,21 @@ def spl_savefile(fit, filename):
             err_gamma_kms = spm.vel_correct(err_gamma, centroid)
 
             # Appending results:
-            results_dict.loc[r, 'Centroid'] = centroid
-            results_dict.loc[r, 'Amplitude'] = amplitude
-            results_dict.loc[r, 'Sigma / A factor'] = sigma
-            results_dict.loc[r, 'Sigma (km/s)'] = sigma_kms
-            results_dict.loc[r, 'Gamma / w width'] = gamma
-            results_dict.loc[r, 'Gamma (km/s)'] = gamma_kms
-            results_dict.loc[r, 'err_Centroid'] = err_centroid
-            results_dict.loc[r, 'err_Amplitude'] = err_amplitude
-            results_dict.loc[r, 'err_Sigma'] = err_sigma
-            results_dict.loc[r, 'err_Sigma (km/s)'] = err_sigma_kms
-            results_dict.loc[r, 'err_Gamma'] = err_gamma
-            results_dict.loc[r, 'err_Gamma (km/s)'] = err_gamma_kms
+            append_row({'Line Name': line,
+                        'Model': model,
+                        'Component': j+1,
+                        'Centroid': centroid,
+                        'Amplitude': amplitude,
+                        'Sigma / A factor': sigma,
+                        'Sigma (km/s)': sigma_kms,
+                        'Gamma / w width': gamma,
+                        'Gamma (km/s)': gamma_kms,
+                        'err_Centroid': err_centroid,
+                        'err_Amplitude': err_amplitude,
+                        'err_Sigma': err_sigma,
+                        'err_Sigma (km/s)': err_sigma_kms,
+                        'err_Gamma': err_gamma,
+                        'err_Gamma (km/s)': err_gamma_kms})
 
             r += 1
 
@@ -588,33 +652,17 @@ def spl_savefile(fit, filename):
 
 
     # Append continuum and goodness of fit
-    results_dict.loc[r, 'Line Name'] = 'Continuum'
-    results_dict.loc[r, 'Component'] = np.nan
-    results_dict.loc[r, 'Model'] = 'Broken Power Law'
-    results_dict.loc[r, 'Centroid'] = 'p1'
-    results_dict.loc[r, 'Amplitude'] = 'p2'
-    results_dict.loc[r, 'Sigma'] = 'p3'
-    results_dict.loc[r+1, 'Line Name'] = 'Continuum'
-    results_dict.loc[r+1, 'Component'] = np.nan
-    results_dict.loc[r+1, 'Model'] = 'Broken Power Law'
-    results_dict.loc[r+1, 'Centroid'] = continuum[0]
-    results_dict.loc[r+1, 'Amplitude'] = continuum[1]
-    results_dict.loc[r+1, 'Sigma'] = continuum[2]
-
-    results_dict.loc[r+2, 'Line Name'] = 'Goodness'
-    results_dict.loc[r+2, 'Component'] = np.nan
-    results_dict.loc[r+2, 'Model'] = 'Goodness of Fit'
-    results_dict.loc[r+2, 'Centroid'] = 'chi2'
-    results_dict.loc[r+2, 'Amplitude'] = 'reduced chi2'
-    results_dict.loc[r+2, 'Sigma'] = 'BIC'
-    results_dict.loc[r+3, 'Line Name'] = 'Goodness'
-    results_dict.loc[r+3, 'Component'] = np.nan
-    results_dict.loc[r+3, 'Model'] = 'Goodness of Fit'
-    results_dict.loc[r+3, 'Centroid'] = goodness['chi squared']
-    results_dict.loc[r+3, 'Amplitude'] = goodness['reduced chi squared']
-    results_dict.loc[r+3, 'Sigma'] = goodness['BIC']
-
-
+    append_row({'Line Name': 'Continuum', 'Model': 'Broken Power Law',
+                'Centroid': 'p1', 'Amplitude': 'p2', 'Sigma': 'p3'})
+    append_row({'Line Name': 'Continuum', 'Model': 'Broken Power Law',
+                'Centroid': continuum[0], 'Amplitude': continuum[1], 'Sigma': continuum[2]})
+
+    append_row({'Line Name': 'Goodness', 'Model': 'Goodness of Fit',
+                'Centroid': 'chi2', 'Amplitude': 'reduced chi2', 'Sigma': 'BIC'})
+    append_row({'Line Name': 'Goodness', 'Model': 'Goodness of Fit',
+                'Centroid': goodness['chi squared'],
+                'Amplitude': goodness['reduced chi squared'],
+                'Sigma': goodness['BIC']})
 
     tab = pd.DataFrame(results_dict)
     tab.to_csv(filename, index=False)